@@ -1,15 +1,22 @@
 import os
-from fastapi import FastAPI, HTTPException, Depends, Request, Response
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
+from starlette.background import BackgroundTask
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 import httpx
+import msgspec
+import orjson
 from dotenv import load_dotenv
-from typing import Callable, List, Dict, Any
+from collections import OrderedDict, deque
+from typing import List, Deque, Dict, Any, Optional, Tuple
 from datetime import datetime
-import hashlib
 import hmac
-import uuid
+import itertools
 import logging
 import json
+import random
 import time
 
 logging.basicConfig(
@@ -18,188 +25,315 @@ logging.basicConfig(
 )
 logger = logging.getLogger("api")
 
+load_dotenv()
+TOKEN = os.getenv("WHATSAPP_API_TOKEN")
+PHONE_ID = os.getenv("WHATSAPP_PHONE_ID")
+SEND_URL = f"/v22.0/{PHONE_ID}/messages"  # relative to the shared client's base_url
+AUTH_HEADERS = {"Authorization": f"Bearer {TOKEN}", "Content-Type": "application/json"}
+APP_SECRET_BYTES = os.getenv("META_APP_SECRET", "").encode("utf-8")
+SIGNATURE_HEADER_LENGTH = len("sha256=") + 64
+PAYLOAD_TEMPLATE = {"messaging_product": "whatsapp", "type": "text"}
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Share one HTTP/2 client across requests for keep-alive to the Graph API"""
+    app.state.http = httpx.AsyncClient(
+        base_url="https://graph.facebook.com",
+        timeout=10.0,
+        http2=True,
+        # Concurrent sends multiplex as HTTP/2 streams over a single kept-alive connection
+        limits=httpx.Limits(max_keepalive_connections=1, max_connections=100, keepalive_expiry=60),
+    )
+    yield
+    await app.state.http.aclose()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
-message_status_store = {}
-recent_requests: List[Dict[str, Any]] = []
 MAX_STORED_REQUESTS = 100
+MAX_STORED_STATUSES = 10_000
+STATUS_SHARDS = 16  # must be a power of two
+MAX_STATUSES_PER_SHARD = MAX_STORED_STATUSES // STATUS_SHARDS
+message_shards: List["OrderedDict[str, Dict[str, Any]]"] = [OrderedDict() for _ in range(STATUS_SHARDS)]
+recent_requests: Deque[Dict[str, Any]] = deque(maxlen=MAX_STORED_REQUESTS)
+BODY_LOG_MAX_BYTES = 4096
+BODY_LOG_SAMPLE_RATE = 0.01
+request_counter = itertools.count()
+STATUS_DEDUPE_TTL = 600.0
+MAX_PROCESSED_STATUSES = 10_000
+processed_statuses: "OrderedDict[Tuple[str, str], float]" = OrderedDict()
 
 
 @app.post("/send-whatsapp-message")
-async def send_whatsapp_message(phone_number: str, message: str = "Hello! I'm Mayank. This is a test message sent from Whatsapp API. Bye!", language_code: str = "en_US"):
-    load_dotenv()
-    token = os.getenv("WHATSAPP_API_TOKEN")
-    phone_id = os.getenv("WHATSAPP_PHONE_ID")
-    url = f"https://graph.facebook.com/v22.0/{phone_id}/messages"
-
-    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-
-    payload = {
-        "messaging_product": "whatsapp",
-        "to": phone_number,
-        "type": "text",
-        "text": {
-            "preview_url": True,
-            "body": message,
-        },
-    }
+async def send_whatsapp_message(request: Request, phone_number: str, message: str = "Hello! I'm Mayank. This is a test message sent from Whatsapp API. Bye!", language_code: str = "en_US"):
+    payload = orjson.dumps({**PAYLOAD_TEMPLATE, "to": phone_number, "text": {"preview_url": True, "body": message}})
 
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, headers=headers, json=payload)
-            response.raise_for_status()
-            result = response.json()
+        response = await request.app.state.http.post(SEND_URL, headers=AUTH_HEADERS, content=payload)
+        response.raise_for_status()
+        result = response.json()
+        
+        if "messages" in result and len(result["messages"]) > 0:
+            message_id = result["messages"][0]["id"]
+            store_message_status(message_id, {
+                "phone_number": phone_number,
+                "status": "sent",
+                "details": {}
+            })
             
-            if "messages" in result and len(result["messages"]) > 0:
-                message_id = result["messages"][0]["id"]
-                message_status_store[message_id] = {
-                    "phone_number": phone_number,
-                    "status": "sent",
-                    "details": {}
-                }
-                
-            return {
-                "status": "message_sent",
-                "api_response": result,
-                "note": "This only confirms the API accepted your request. Check webhook for delivery status."
-            }
+        return {
+            "status": "message_sent",
+            "api_response": result,
+            "note": "This only confirms the API accepted your request. Check webhook for delivery status."
+        }
     except httpx.HTTPStatusError as e:
         raise HTTPException(status_code=e.response.status_code, detail=f"WhatsApp API error: {e.response.text}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to send WhatsApp message: {str(e)}")
     
-async def verify_webhook_signature(request: Request):
-    """Verify that incoming webhooks are from Meta using the signature"""
-    app_secret = os.getenv("META_APP_SECRET")
+class ChangeValue(msgspec.Struct):
+    # Statuses stay raw mappings so details keep every field Meta sends
+    statuses: List[Dict[str, Any]] = []
+
+class Change(msgspec.Struct):
+    field: str
+    value: ChangeValue = msgspec.field(default_factory=ChangeValue)
+
+class Entry(msgspec.Struct):
+    changes: List[Change] = []
+
+class WebhookEvent(msgspec.Struct):
+    entry: List[Entry] = []
+    hub_mode: Optional[str] = msgspec.field(default=None, name="hub.mode")
+    hub_verify_token: Optional[str] = msgspec.field(default=None, name="hub.verify_token")
+    hub_challenge: Any = msgspec.field(default=None, name="hub.challenge")
+
+webhook_decoder = msgspec.json.Decoder(WebhookEvent)
+
+async def verify_webhook_signature(request: Request) -> bytes:
+    """Verify that incoming webhooks are from Meta using the signature and return the raw body"""
     signature = request.headers.get("x-hub-signature-256", "")
     
     if not signature:
-        return True 
+        return await request.body()
     
-    body = await request.body()
+    # Fail closed: an empty key would let anyone compute a valid signature
+    if not APP_SECRET_BYTES:
+        logger.error("META_APP_SECRET is not set; rejecting signed webhook")
+        raise HTTPException(status_code=403, detail="Invalid webhook signature")
     
-    # Generate the expected signature
-    expected_signature = "sha256=" + hmac.new(
-        app_secret.encode('utf-8'),
-        body,
-        hashlib.sha256
-    ).hexdigest()
+    # Reject malformed headers before touching the body
+    if not signature.startswith("sha256=") or len(signature) != SIGNATURE_HEADER_LENGTH:
+        raise HTTPException(status_code=403, detail="Invalid webhook signature")
+    try:
+        provided = bytes.fromhex(signature[7:])
+    except ValueError:
+        raise HTTPException(status_code=403, detail="Invalid webhook signature")
     
-    # Compare signatures
-    if not hmac.compare_digest(signature, expected_signature):
+    body = await request.body()
+    
+    # One-shot C HMAC; compare raw digests rather than their hex encodings
+    expected = hmac.digest(APP_SECRET_BYTES, body, "sha256")
+    if not hmac.compare_digest(expected, provided):
         raise HTTPException(status_code=403, detail="Invalid webhook signature")
     
-    return True
+    return body
 
 @app.post("/whatsapp/webhook")
-async def whatsapp_webhook(request: Request, verified: bool = Depends(verify_webhook_signature)):
+async def whatsapp_webhook(raw_body: bytes = Depends(verify_webhook_signature)):
     """Receive webhook notifications from WhatsApp"""
-    body = await request.json()
+    try:
+        event = webhook_decoder.decode(raw_body)
+    except msgspec.ValidationError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid webhook payload: {str(e)}")
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Malformed webhook body: {str(e)}")
     
     # Handle webhook verification challenge
-    if "hub.mode" in body and body["hub.mode"] == "subscribe":
-        if body["hub.verify_token"] == os.environ.get("WEBHOOK_VERIFY_TOKEN", "your_verify_token"):
-            return {"hub.challenge": body["hub.challenge"]}
+    if event.hub_mode == "subscribe":
+        if event.hub_verify_token == os.environ.get("WEBHOOK_VERIFY_TOKEN", "your_verify_token"):
+            return {"hub.challenge": event.hub_challenge}
         else:
             raise HTTPException(status_code=403, detail="Verification token mismatch")
     
-    # Process status updates
+    # Acknowledge immediately and apply status updates after the response is sent
+    return ORJSONResponse({"status": "received"}, background=BackgroundTask(process_webhook_event, event))
+
+async def process_webhook_event(event: WebhookEvent):
+    """Apply all message status updates carried by a webhook event"""
+    # async so Starlette runs it on the event loop, never in a worker thread
+    # racing the endpoints that read the status stores
     try:
-        if "entry" in body:
-            for entry in body["entry"]:
-                for change in entry.get("changes", []):
-                    if change.get("field") == "messages":
-                        process_message_status_updates(change.get("value", {}))
-        
-        return {"status": "received"}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to process webhook: {str(e)}")
+        for entry in event.entry:
+            for change in entry.changes:
+                if change.field == "messages":
+                    process_message_status_updates(change.value)
+    except Exception:
+        logger.exception("Failed to process webhook")
+
+def status_shard(message_id: str) -> "OrderedDict[str, Dict[str, Any]]":
+    """Pick the status shard that owns a message id"""
+    return message_shards[hash(message_id) & (STATUS_SHARDS - 1)]
 
-def process_message_status_updates(data: Dict[str, Any]):
+def store_message_status(message_id: str, entry: Dict[str, Any]):
+    """Track a message status, evicting the least recently updated once full"""
+    shard = status_shard(message_id)
+    shard[message_id] = entry
+    shard.move_to_end(message_id)
+    if len(shard) > MAX_STATUSES_PER_SHARD:
+        shard.popitem(last=False)
+
+def process_message_status_updates(data: ChangeValue):
     """Process message status updates from webhooks"""
     # Handle delivery status updates
-    if "statuses" in data:
-        for status in data["statuses"]:
-            message_id = status.get("id")
-            if message_id in message_status_store:
-                message_status_store[message_id]["status"] = status.get("status")
-                message_status_store[message_id]["details"] = status
-                print(f"Message {message_id} status updated to: {status.get('status')}")
+    statuses = data.statuses
+    if not statuses:
+        return
+
+    now = time.monotonic()
+    # Entries share one TTL, so the oldest insertions expire first
+    while processed_statuses and next(iter(processed_statuses.values())) <= now:
+        processed_statuses.popitem(last=False)
+
+    updated = 0
+    for status in statuses:
+        # Skip status transitions already applied by an earlier delivery
+        message_id = status.get("id")
+        seen_key = (message_id, status.get("status"))
+        if seen_key in processed_statuses:
+            continue
+
+        shard = status_shard(message_id)
+        entry = shard.get(message_id)
+        if entry is None:
+            continue
+        shard.move_to_end(message_id)
+        entry["status"] = status.get("status")
+        entry["details"] = status
+        updated += 1
+
+        # Only applied updates count as processed, so retries for ids not yet stored still land
+        processed_statuses[seen_key] = now + STATUS_DEDUPE_TTL
+        if len(processed_statuses) > MAX_PROCESSED_STATUSES:
+            processed_statuses.popitem(last=False)
+
+    if updated:
+        logger.debug("Updated %d of %d message statuses", updated, len(statuses))
 
 @app.get("/message-status/{message_id}")
 async def get_message_status(message_id: str):
     """Get the delivery status of a message"""
-    if message_id in message_status_store:
-        return message_status_store[message_id]
+    entry = status_shard(message_id).get(message_id)
+    if entry is not None:
+        return entry
     raise HTTPException(status_code=404, detail="Message ID not found")
 
 @app.get("/all-message-statuses")
 async def get_all_message_statuses():
     """Get statuses of all tracked messages"""
-    return message_status_store
+    return {k: v for shard in message_shards for k, v in shard.items()}
 
-@app.middleware("http")
-async def log_requests(request: Request, call_next: Callable) -> Response:
+class LogRequestsMiddleware:
     """Log all requests and responses"""
-    request_id = str(uuid.uuid4())
-    request_path = request.url.path
-    request_query = str(request.query_params)
-    client_host = request.client.host if request.client else "unknown"
-    
-    start_time = time.time()
-    
-    request_body = ""
-    if request_path != "/whatsapp/webhook": #webhooks too large to be logged so skipping
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        # Webhooks arrive at high rates from Meta, so they skip logging entirely
+        if scope["type"] != "http" or scope["path"] == "/whatsapp/webhook":
+            await self.app(scope, receive, send)
+            return
+
+        start_ns = time.time_ns()
+        request_id = f"{start_ns:x}{next(request_counter):x}"
+        request_path = scope["path"]
+        request_query = scope.get("query_string", b"").decode("latin-1")
+        client = scope.get("client")
+        client_host = client[0] if client else "unknown"
+        content_length = None
+        for name, value in scope["headers"]:
+            if name == b"content-length":
+                content_length = int(value) if value.isdigit() else None
+                break
+
+        start_time = time.perf_counter()
+        status_code = 500
+        duration = None
+        error_detail = None
+
+        # Only a small sample of small bodies is logged, captured as the app consumes them
+        body_chunks: List[bytes] = []
+        if (
+            content_length is not None
+            and 0 < content_length <= BODY_LOG_MAX_BYTES
+            and random.random() < BODY_LOG_SAMPLE_RATE
+        ):
+            async def receive_wrapper() -> Message:
+                message = await receive()
+                if message["type"] == "http.request":
+                    body_chunks.append(message.get("body", b""))
+                return message
+        else:
+            receive_wrapper = receive
+
+        async def send_wrapper(message: Message):
+            nonlocal status_code, duration
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                duration = time.perf_counter() - start_time
+            await send(message)
+
         try:
-            body_bytes = await request.body()
-            request.scope["_body"] = body_bytes 
-            if body_bytes:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        except Exception as e:
+            logger.exception("Request failed: %s", e)
+            status_code = 500
+            error_detail = str(e)
+            raise
+        finally:
+            if duration is None:
+                duration = time.perf_counter() - start_time
+
+            request_body = ""
+            if body_chunks:
                 try:
-                    request_body = body_bytes.decode()
+                    request_body = b"".join(body_chunks).decode()
                 except UnicodeDecodeError:
                     request_body = "[binary data]"
-        except Exception as e:
-            request_body = f"[Error reading body: {str(e)}]"
-    
-    try:
-        response = await call_next(request)
-        status_code = response.status_code
-        error_detail = None
-    except Exception as e:
-        logger.exception(f"Request failed: {str(e)}")
-        status_code = 500
-        error_detail = str(e)
-        raise
-    finally:
-        duration = time.time() - start_time
-        
-        log_entry = {
-            "id": request_id,
-            "timestamp": datetime.utcnow().isoformat(),
-            "method": request.method,
-            "path": request_path,
-            "query": request_query,
-            "client_ip": client_host,
-            "status_code": status_code,
-            "duration_ms": round(duration * 1000, 2),
-            "body": request_body if request_body else None,
-            "error": error_detail
-        }
-        
-        logger.info(f"Request: {log_entry['method']} {log_entry['path']} - Status: {log_entry['status_code']} - Duration: {log_entry['duration_ms']}ms")
-        
-        recent_requests.append(log_entry)
-        if len(recent_requests) > MAX_STORED_REQUESTS:
-            recent_requests.pop(0)
-        
-    return response
+
+            log_entry = {
+                "id": request_id,
+                "timestamp": start_ns,
+                "method": scope["method"],
+                "path": request_path,
+                "query": request_query,
+                "client_ip": client_host,
+                "status_code": status_code,
+                "duration_ms": round(duration * 1000, 2),
+                "content_length": content_length,
+                "body": request_body if request_body else None,
+                "error": error_detail
+            }
+
+            logger.info(
+                "Request: %s %s - Status: %s - Duration: %sms",
+                log_entry["method"], log_entry["path"], log_entry["status_code"], log_entry["duration_ms"],
+            )
+
+            recent_requests.append(log_entry)
+
+app.add_middleware(LogRequestsMiddleware)
 
 @app.get("/monitoring/requests")
 async def get_recent_requests():
     """Endpoint to view recent request logs"""
-    return {"requests": recent_requests}
+    # Timestamps are stored as epoch nanoseconds and only formatted when viewed
+    return {"requests": [
+        {**entry, "timestamp": datetime.utcfromtimestamp(entry["timestamp"] / 1e9).isoformat()}
+        for entry in recent_requests
+    ]}
 
 @app.get("/")
 async def root():